@@ -1,40 +1,76 @@
 import socket
+import heapq
 import argparse
+import logging
+import logging.handlers
+import queue
+import selectors
 import sys
 import time
-import threading
-import numpy as np
-from datetime import datetime
+from collections import deque
+
+logger = logging.getLogger(__name__)
 
 MAX_SENSOR_READINGS = 30
 SLOPE_THRESHOLD = 5.0
 VALVE_DURATION = 600
+STATUS_INTERVAL = 60
+RECV_BUFFER_SIZE = 65536
+SOCKET_RCVBUF = 262144
+
+# Closed-form least-squares terms for x = 0..n-1, indexed by window size n
+SX = [n * (n - 1) // 2 for n in range(MAX_SENSOR_READINGS + 1)]
+SXX = [(n - 1) * n * (2 * n - 1) // 6 for n in range(MAX_SENSOR_READINGS + 1)]
+DENOM = [n * SXX[n] - SX[n] ** 2 for n in range(MAX_SENSOR_READINGS + 1)]
+
+# The border router prints sensor ids as decimal uint8
+SENSOR_IDS = {b"%d" % i: i for i in range(256)}
+# Every (sensor_id, command) line the server can send, pre-encoded
+COMMANDS = {(i, command): b"COMMAND %d %d\n" % (i, command) for i in range(256) for command in (0, 1)}
 
 class SensorData:
+    __slots__ = ('sensor_id', 'readings', '_sum_y', '_sum_xy', 'last_timestamp',
+                 'last_update', 'valve_open', 'valve_open_time')
+
     def __init__(self, sensor_id):
         self.sensor_id = sensor_id
-        self.readings = []
-        self.timestamps = []
-        self.last_update = time.time()
+        self.readings = deque(maxlen=MAX_SENSOR_READINGS)
+        self._sum_y = 0
+        self._sum_xy = 0
+        self.last_timestamp = None
+        self.last_update = time.monotonic()
         self.valve_open = False
         self.valve_open_time = 0
 
-    def add_reading(self, value, timestamp):
+    def __len__(self):
+        return len(self.readings)
+
+    def add_reading(self, value, timestamp, now):
+        """Add a reading; returns False if it repeats the last timestamp"""
+        # The timestamp is the border router's clock_seconds() at reception, so
+        # only an exact repeat is dropped; a backwards jump means the router restarted
+        if timestamp is not None:
+            if timestamp == self.last_timestamp:
+                return False
+            self.last_timestamp = timestamp
+        n = len(self.readings)
+        if n == MAX_SENSOR_READINGS:
+            # Evicting the oldest reading shifts every remaining x down by one
+            old = self.readings[0]
+            self._sum_xy += (n - 1) * value - (self._sum_y - old)
+            self._sum_y += value - old
+        else:
+            self._sum_xy += n * value
+            self._sum_y += value
         self.readings.append(value)
-        self.timestamps.append(timestamp)
-        self.last_update = time.time()
-        if len(self.readings) > MAX_SENSOR_READINGS:
-            self.readings.pop(0)
-            self.timestamps.pop(0)
+        self.last_update = now
+        return True
     
     def calculate_slope(self):
-        if len(self.readings) < 2:
+        n = len(self.readings)
+        if n < 2:
             return 0
-        x = np.array(range(len(self.readings)))
-        y = np.array(self.readings)
-        n = len(x)
-        slope = (n * np.sum(x * y) - np.sum(x) * np.sum(y)) / (n * np.sum(x**2) - np.sum(x)**2)
-        return slope
+        return (n * self._sum_xy - SX[n] * self._sum_y) / DENOM[n]
 
 
 class Server:
@@ -44,111 +80,170 @@ class Server:
         self.socket = None
         self.sensors = {}
         self.running = False
+        self._timers = []
+        self._now = time.monotonic()
+        self._recv_buf = bytearray(RECV_BUFFER_SIZE)
+        self._recv_view = memoryview(self._recv_buf)
+        self._handlers = {b"DATA": self.handle_data}
+        self._pending = {}
+        self._pending_out = []
+        self._handler_initials = frozenset(tag[:1] for tag in self._handlers)
     
     def start(self):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         
         try:
-            print(f"Connecting to border router at {self.ip}:{self.port}...")
+            # Set before connect so the enlarged window is advertised in the handshake
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RCVBUF)
+            logger.info("Connecting to border router at %s:%s...", self.ip, self.port)
             self.socket.connect((self.ip, self.port))
-            print("Connected successfully!")
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            logger.info("Connected successfully!")
     
             self.running = True
-            valve_thread = threading.Thread(target=self.check_valves)
-            valve_thread.daemon = True
-            valve_thread.start()
-            
-            status_thread = threading.Thread(target=self.print_status_periodically)
-            status_thread.daemon = True
-            status_thread.start()
-
+            heapq.heappush(self._timers, (time.monotonic() + STATUS_INTERVAL, "status", None))
             self.handle_messages()
             
         except Exception as e:
-            print(f"Error connecting to border router: {e}")
+            logger.error("Error connecting to border router: %s", e)
             if self.socket:
                 self.socket.close()
     
     def handle_messages(self):
-        buffer = ""
+        """Run the event loop: read border-router lines and fire due timers"""
+        selector = selectors.DefaultSelector()
+        selector.register(self.socket, selectors.EVENT_READ)
+        buffer = bytearray()
         while self.running:
             try:
-                data = self.socket.recv(1024).decode('utf-8')
-                if not data:
-                    print("Connection closed by border router")
+                timeout = max(0, self._timers[0][0] - time.monotonic()) if self._timers else None
+                ready = selector.select(timeout)
+                self._now = time.monotonic()
+                if ready and not self.receive_messages(buffer):
                     break
-                
-                buffer += data
-                lines = buffer.split('\n')
-                buffer = lines.pop()
-                
-                for line in lines:
-                    if line.strip():
-                        self.process_message(line.strip())
+                self.run_timers(self._now)
+                self.flush_out()
             except Exception as e:
-                print(f"Error handling messages: {e}")
+                logger.error("Error handling messages: %s", e)
                 break
         
+        selector.close()
         if self.socket:
             self.socket.close()
             self.socket = None
     
+    def receive_messages(self, buffer):
+        n = self.socket.recv_into(self._recv_view)
+        if not n:
+            logger.info("Connection closed by border router")
+            return False
+        
+        # Only a partial line left over from the previous read is copied into buffer
+        if buffer:
+            buffer += self._recv_view[:n]
+            data, end = buffer, len(buffer)
+        else:
+            data, end = self._recv_buf, n
+        
+        start = 0
+        with memoryview(data) as view:
+            while (nl := data.find(b'\n', start, end)) >= 0:
+                line = bytes(view[start:nl]).strip()
+                start = nl + 1
+                if line:
+                    self.process_message(line)
+        if data is buffer:
+            del buffer[:start]
+        else:
+            buffer += self._recv_view[start:n]
+        self.apply_readings()
+        return True
+
     def process_message(self, message):
-        print(f"Received: {message}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received: %s", message.decode('utf-8', 'replace'))
         
-        if message.startswith("DATA "):
-            parts = message.split()
-            if len(parts) >= 3:
-                try:
-                    if len(parts) >= 4:
-                        sensor_id = int(parts[1])
-                        value = int(parts[2])
-                        timestamp = int(parts[3])
-                    else:
-                        sensor_id = int(parts[1])
-                        value = int(parts[2])
-                        timestamp = int(time.time())
-
-                    if sensor_id not in self.sensors:
-                        self.sensors[sensor_id] = SensorData(sensor_id)
-                    
-                    self.sensors[sensor_id].add_reading(value, timestamp)
-                    print(f"Received data from sensor {sensor_id}: {value}")
-                    
-                    if len(self.sensors[sensor_id].readings) >= 2:
-                        slope = self.sensors[sensor_id].calculate_slope()
-                        print(f"Calculated slope for sensor {sensor_id}: {slope:.2f}")
-
-                        if slope > SLOPE_THRESHOLD and not self.sensors[sensor_id].valve_open:
-                            self.send_command(sensor_id, 1)
-                            self.sensors[sensor_id].valve_open = True
-                            self.sensors[sensor_id].valve_open_time = time.time()
-                            print(f"Opening valve for sensor {sensor_id} for {VALVE_DURATION} seconds")
-                except Exception as e:
-                    print(f"Error processing data message: {e}")
-    
-    def send_command(self, sensor_id, command):
-        if self.socket:
-            message = f"COMMAND {sensor_id} {command}\n"
-            self.socket.sendall(message.encode('utf-8'))
-            print(f"Sent command: {message.strip()}")
-    
-    def check_valves(self):
-        while self.running:
-            current_time = time.time()
+        if message[:1] not in self._handler_initials:
+            return
+        sep = message.find(b' ')
+        if sep < 0:
+            return
+        handler = self._handlers.get(message[:sep])
+        if handler:
+            handler(message[sep + 1:])
+
+    def handle_data(self, payload):
+        parts = payload.split(None, 3)
+        if len(parts) >= 2:
+            try:
+                sensor_id = SENSOR_IDS[parts[0]]
+                value = int(parts[1])
+                timestamp = int(parts[2]) if len(parts) >= 3 else None
+                self._pending.setdefault(sensor_id, []).append((value, timestamp))
+                logger.debug("Received data from sensor %s: %s", sensor_id, value)
+            except (KeyError, ValueError):
+                logger.warning("Ignoring malformed DATA line: %r", payload)
+
+    def apply_readings(self):
+        """Add the readings batched from one receive and evaluate each touched sensor once"""
+        for sensor_id, values in self._pending.items():
+            sensor = self.sensors.get(sensor_id)
+            if sensor is None:
+                sensor = self.sensors[sensor_id] = SensorData(sensor_id)
             
-            for sensor_id, sensor in list(self.sensors.items()):
-                if sensor.valve_open and current_time - sensor.valve_open_time >= VALVE_DURATION:
-                    self.send_command(sensor_id, 0)
-                    sensor.valve_open = False
-                    print(f"Closing valve for sensor {sensor_id} (timer expired)")
+            accepted = False
+            for value, timestamp in values:
+                if sensor.add_reading(value, timestamp, self._now):
+                    accepted = True
+                else:
+                    logger.warning("Dropped repeated reading from sensor %s: %s at %s", sensor_id, value, timestamp)
             
-            time.sleep(1)
+            if accepted and len(sensor) >= 2:
+                slope = sensor.calculate_slope()
+                logger.debug("Calculated slope for sensor %s: %.2f", sensor_id, slope)
+
+                if slope > SLOPE_THRESHOLD and not sensor.valve_open:
+                    self.send_command(sensor_id, 1)
+                    sensor.valve_open = True
+                    sensor.valve_open_time = self._now
+                    self.schedule_valve_close(sensor_id, sensor.valve_open_time + VALVE_DURATION)
+                    logger.info("Opening valve for sensor %s for %s seconds", sensor_id, VALVE_DURATION)
+        self._pending.clear()
     
-    def print_status_periodically(self):
-        while self.running:
-            time.sleep(60)
-            self.print_network_status()
+    def send_command(self, sensor_id, command):
+        """Queue a command; it is written by the next flush_out()"""
+        self._pending_out.append(COMMANDS[(sensor_id, command)])
+        logger.debug("Queued command: COMMAND %s %s", sensor_id, command)
+
+    def flush_out(self):
+        """Send all queued commands to the border router in a single write"""
+        if self._pending_out and self.socket:
+            self.socket.sendall(b"".join(self._pending_out))
+        self._pending_out.clear()
+    
+    def schedule_valve_close(self, sensor_id, deadline):
+        heapq.heappush(self._timers, (deadline, "valve", sensor_id))
+
+    def run_timers(self, current_time):
+        due = []
+        while self._timers and self._timers[0][0] <= current_time:
+            _, kind, sensor_id = heapq.heappop(self._timers)
+            if kind == "valve":
+                due.append(sensor_id)
+            elif kind == "status":
+                self.print_network_status()
+                heapq.heappush(self._timers, (current_time + STATUS_INTERVAL, "status", None))
+        if due:
+            self.check_valves(due)
+
+    def check_valves(self, due):
+        # The popped deadline is authoritative; recomputing the duration can round the other way
+        for sensor_id in due:
+            sensor = self.sensors[sensor_id]
+            if sensor.valve_open:
+                self.send_command(sensor_id, 0)
+                sensor.valve_open = False
+                logger.info("Closing valve for sensor %s (timer expired)", sensor_id)
     
     def stop(self):
         self.running = False
@@ -157,29 +252,38 @@ class Server:
 
     def print_network_status(self):
         """Print current network status"""
-        print("\n=== Network Status ===")
-        print(f"Connected sensors: {len(self.sensors)}")
+        logger.info("\n=== Network Status ===")
+        logger.info("Connected sensors: %s", len(self.sensors))
         for sensor_id, sensor in self.sensors.items():
             valve_status = "OPEN" if sensor.valve_open else "CLOSED"
-            readings = sensor.readings[-5:] if sensor.readings else []
-            print(f"Sensor {sensor_id}: Valve {valve_status}, Last 5 readings: {readings}")
-        print("=====================\n")
+            readings = list(sensor.readings)[-5:]
+            logger.info("Sensor %s: Valve %s, Last 5 readings: %s", sensor_id, valve_status, readings)
+        logger.info("=====================\n")
 
 
 def main():
     parser = argparse.ArgumentParser(description="Building Management Server")
     parser.add_argument("--ip", dest="ip", type=str, default="localhost", help="IP address of the border router")
     parser.add_argument("--port", dest="port", type=int, default=60001, help="Port of the border router")
+    parser.add_argument("--verbose", action="store_true", help="Log every received message and computed slope")
     args = parser.parse_args()
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    # Records are only enqueued on the server thread; stdout writes happen on the listener thread
+    log_queue = queue.SimpleQueue()
+    logging.getLogger().addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+    listener.start()
     
     server = Server(args.ip, args.port)
     
     try:
         server.start()
     except KeyboardInterrupt:
-        print("Server shutting down...")
+        logger.info("Server shutting down...")
     finally:
         server.stop()
+        listener.stop()
 
 if __name__ == "__main__":
     main()